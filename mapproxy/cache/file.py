@@ -130,7 +130,7 @@ class FileCache(TileCacheBase):
         if tile.stored:
             return
 
-        tile_loc = self.tile_location(tile, create_dir=True)
+        tile_loc = self.tile_location(tile)
 
         if self.link_single_color_images:
             color = is_single_color_image(tile.source.as_image())
@@ -147,16 +147,19 @@ class FileCache(TileCacheBase):
 
         with tile_buffer(tile) as buf:
             log.debug('writing %r to %s' % (tile.coord, location))
+            ensure_directory(location, cached=True)
             write_atomic(location, buf.read())
 
     def _store_single_color_tile(self, tile, tile_loc, color):
-        real_tile_loc = self._single_color_tile_location(color, create_dir=True)
+        real_tile_loc = self._single_color_tile_location(color)
         if not os.path.exists(real_tile_loc):
             self._store(tile, real_tile_loc)
 
         log.debug('linking %r from %s to %s',
                   tile.coord, real_tile_loc, tile_loc)
 
+        ensure_directory(tile_loc)
+
         # remove any file before symlinking.
         # exists() returns False if it links to non-
         # existing file, islink() test to check that
@@ -18,7 +18,6 @@ System-wide configuration.
 """
 import os
 import copy
-import contextlib
 from mapproxy.util.yaml import load_yaml_file
 from mapproxy.util.ext.local import LocalStack
 from mapproxy.compat import iteritems
@@ -83,8 +82,7 @@ def base_config():
         _config.push(config)
     return config
 
-@contextlib.contextmanager
-def local_base_config(conf):
+class local_base_config(object):
     """
     Temporarily set the global configuration (mapproxy.config.base_config).
 
@@ -92,13 +90,20 @@ def local_base_config(conf):
     is set per-request in the MapProxyApp. Use `local_base_config` to
     set base_config outside of a request context (e.g. system loading
     or seeding).
+
+    Implemented as a class instead of a contextmanager generator, as it
+    is used for each request.
     """
-    import mapproxy.config.config
-    mapproxy.config.config._config.push(conf)
-    try:
-        yield
-    finally:
-        mapproxy.config.config._config.pop()
+    __slots__ = ('conf', )
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def __enter__(self):
+        _config.push(self.conf)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _config.pop()
 
 def _to_options_map(mapping):
     if isinstance(mapping, dict):
@@ -26,7 +26,7 @@ from mapproxy.seed.seeder import (
 from mapproxy.seed.util import ProgressLog
 
 def cleanup(tasks, concurrency=2, dry_run=False, skip_geoms_for_last_levels=0,
-               verbose=True, progress_logger=None):
+               verbose=True, progress_logger=None, cleanup_concurrency=1):
     for task in tasks:
         print(format_cleanup_task(task))
 
@@ -46,7 +46,7 @@ def cleanup(tasks, concurrency=2, dry_run=False, skip_geoms_for_last_levels=0,
         if task.complete_extent:
             if callable(getattr(task.tile_manager.cache, 'level_location', None)):
                 simple_cleanup(task, dry_run=dry_run, progress_logger=progress_logger,
-                    cleanup_progress=cleanup_progress)
+                    cleanup_progress=cleanup_progress, concurrency=cleanup_concurrency)
                 task.tile_manager.cleanup()
                 continue
             elif callable(getattr(task.tile_manager.cache, 'remove_level_tiles_before', None)):
@@ -62,7 +62,8 @@ def cleanup(tasks, concurrency=2, dry_run=False, skip_geoms_for_last_levels=0,
         task.tile_manager.cleanup()
 
 
-def simple_cleanup(task, dry_run, progress_logger=None, cleanup_progress=None):
+def simple_cleanup(task, dry_run, progress_logger=None, cleanup_progress=None,
+                   concurrency=1):
     """
     Cleanup cache level on file system level.
     """
@@ -86,8 +87,10 @@ def simple_cleanup(task, dry_run, progress_logger=None, cleanup_progress=None):
                 )
                 progress_logger.progress_store.write()
 
+        # dry-run prints each file, keep output in order
         cleanup_directory(level_dir, task.remove_timestamp,
-            file_handler=file_handler, remove_empty_dirs=True)
+            file_handler=file_handler, remove_empty_dirs=True,
+            concurrency=1 if dry_run else concurrency)
 
 def cache_cleanup(task, dry_run, progress_logger=None):
     for level in task.levels:
@@ -97,6 +97,11 @@ class SeedScript(object):
     parser.add_option("-c", "--concurrency", type="int",
                       dest="concurrency", default=2,
                       help="number of parallel seed processes")
+    parser.add_option("--cleanup-concurrency", type="int",
+                      dest="cleanup_concurrency", default=1,
+                      metavar="N",
+                      help="number of threads for removing tiles of complete"
+                           " levels in file caches")
     parser.add_option("-n", "--dry-run",
                       action="store_true", dest="dry_run", default=False,
                       help="do not seed, just print output")
@@ -252,7 +257,8 @@ class SeedScript(object):
                         progress_store=progress)
                     cleanup(cleanup_tasks, verbose=options.quiet==0, dry_run=options.dry_run,
                             concurrency=options.concurrency, progress_logger=logger,
-                            skip_geoms_for_last_levels=options.geom_levels)
+                            skip_geoms_for_last_levels=options.geom_levels,
+                            cleanup_concurrency=options.cleanup_concurrency)
             except SeedInterrupted:
                 print('\ninterrupted...')
                 return 3
@@ -377,6 +377,10 @@ class WMSServer(Server):
             return self.root_layer
 
 class FilteredRootLayer(object):
+    # created for each layer of each capabilities request with partial
+    # authorization, use slots to avoid a __dict__ per instance
+    __slots__ = ('root_layer', 'permissions', 'coverage', '_extent', '_layers')
+
     def __init__(self, root_layer, permissions, coverage=None):
         self.root_layer = root_layer
         self.permissions = permissions
@@ -385,7 +389,7 @@ class FilteredRootLayer(object):
     def __getattr__(self, name):
         return getattr(self.root_layer, name)
 
-    @cached_property
+    @cached_property(slot='_extent')
     def extent(self):
         layer_name = self.root_layer.name
         limited_to = self.permissions.get(layer_name, {}).get('limited_to')
@@ -426,7 +430,7 @@ class FilteredRootLayer(object):
                 return False
         return True
 
-    @cached_property
+    @cached_property(slot='_layers')
     def layers(self):
         layers = []
         for layer in self.root_layer.layers:
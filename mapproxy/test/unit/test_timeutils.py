@@ -14,7 +14,12 @@
 # limitations under the License.
 
 from datetime import datetime
-from mapproxy.util.times import parse_httpdate, format_httpdate, timestamp
+from mapproxy.util.times import (
+    parse_httpdate,
+    format_httpdate,
+    timestamp,
+    timestamp_from_isodate,
+)
 
 import pytest
 
@@ -48,3 +53,26 @@ class TestHTTPDate(object):
 def test_timestamp():
     assert timestamp(1234567890) == 1234567890
     assert timestamp(datetime.fromtimestamp(1234567890)) == 1234567890
+
+
+class TestTimestampFromIsodate(object):
+
+    def test_isodate(self):
+        assert timestamp_from_isodate("2009-02-13T23:31:30") == timestamp(
+            datetime(2009, 2, 13, 23, 31, 30)
+        )
+        assert timestamp_from_isodate("2009-2-13T23:31:30") == timestamp(
+            datetime(2009, 2, 13, 23, 31, 30)
+        )
+
+    @pytest.mark.parametrize("isodate", [
+        "2009-02-13T23:31",
+        "2009-02-13 23:31:30",
+        "2009-02-13T23:31:30+01:00",
+        "2009-02-13T25:31:30",
+        "2009-W07-5T23:31:30",
+        "2009-02-13T233130.5",
+    ])
+    def test_invalid(self, isodate):
+        with pytest.raises(ValueError):
+            timestamp_from_isodate(isodate)
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import errno
 import glob
 import multiprocessing
 import os
@@ -22,15 +24,19 @@ import sys
 import tempfile
 import threading
 import time
+import weakref
+
+import pytest
 
 from mapproxy.util.lock import FileLock, SemLock, cleanup_lockdir, LockTimeout
 from mapproxy.util.fs import (
     _force_rename_dir,
     swap_dir,
     cleanup_directory,
+    ensure_directory,
     write_atomic,
 )
-from mapproxy.util.py import reraise_exception
+from mapproxy.util.py import reraise_exception, memoize, cached_property
 from mapproxy.util.times import timestamp_before
 from mapproxy.test.helper import Mocker
 
@@ -291,6 +297,23 @@ class TestForceRenameDir(DirTest):
         assert os.path.exists(os.path.join(dst_dir, "bar.txt"))
         assert not os.path.exists(src_dir)
 
+    def test_rename_fails(self, monkeypatch):
+        src_dir = self.mkdir("bar")
+        dst_dir = self.mkdir("baz")
+        renames = []
+        def rename(src, dst):
+            # dst_dir is recreated by someone else after each rmtree
+            renames.append(dst)
+            raise OSError(errno.ENOTEMPTY, "Directory not empty")
+        monkeypatch.setattr(os, "rename", rename)
+        monkeypatch.setattr(shutil, "rmtree", lambda path: None)
+        monkeypatch.setattr(time, "sleep", lambda seconds: None)
+
+        with pytest.raises(OSError):
+            _force_rename_dir(src_dir, dst_dir)
+        assert len(renames) == 40
+        assert os.path.exists(src_dir)
+
 
 class TestSwapDir(DirTest):
 
@@ -380,7 +403,25 @@ class TestCleanupDirectory(DirTest):
         cleanup_directory(self.tmpdir, timestamp_before(minutes=-1))
         assert not os.path.exists(os.path.join(self.tmpdir, "foo"))
 
-    def test_remove_some(self):
+    def test_keep_empty_dirs(self):
+        filename = self.mkfile("foo")
+        new_date = timestamp_before(weeks=1)
+        os.utime(filename, (new_date, new_date))
+        os.makedirs(os.path.join(self.tmpdir, "bar", "baz"))
+        cleanup_directory(self.tmpdir, timestamp_before(), remove_empty_dirs=False)
+        assert not os.path.exists(filename)
+        assert os.path.exists(os.path.dirname(filename))
+        assert os.path.exists(os.path.join(self.tmpdir, "bar", "baz"))
+
+    def test_remove_all_future_timestamp(self):
+        files = [self.mkfile("foo" + str(n)) for n in range(10)]
+        cleanup_directory(self.tmpdir, timestamp_before(minutes=-1))
+        for filename in files:
+            assert not os.path.exists(filename), filename
+            assert not os.path.exists(os.path.dirname(filename)), filename
+
+    @pytest.mark.parametrize("concurrency", [1, 4])
+    def test_remove_some(self, concurrency):
         files = []
         # create a few files, every other file is one week old
         new_date = timestamp_before(weeks=1)
@@ -396,7 +437,8 @@ class TestCleanupDirectory(DirTest):
             assert os.path.exists(filename), filename
 
         # cleanup_directory for all files older then one minute
-        cleanup_directory(self.tmpdir, timestamp_before(minutes=1))
+        cleanup_directory(self.tmpdir, timestamp_before(minutes=1),
+            concurrency=concurrency)
 
         # check old files and dirs are removed
         for filename in files[::2]:
@@ -407,6 +449,75 @@ class TestCleanupDirectory(DirTest):
         for filename in files[1::2]:
             assert os.path.exists(filename), filename
 
+    def test_remove_nested_concurrent(self):
+        new_date = timestamp_before(weeks=1)
+        files = []
+        for path in ("a/b/c", "a/b/d", "a/e", "f"):
+            dirname = os.path.join(self.tmpdir, path)
+            os.makedirs(dirname)
+            for n in range(20):
+                filename = os.path.join(dirname, str(n) + ".png")
+                open(filename, "wb").close()
+                os.utime(filename, (new_date, new_date))
+                files.append(filename)
+        fresh = os.path.join(self.tmpdir, "a", "b", "fresh.png")
+        open(fresh, "wb").close()
+
+        cleanup_directory(self.tmpdir, timestamp_before(minutes=1), concurrency=4)
+        for filename in files:
+            assert not os.path.exists(filename), filename
+        assert os.path.exists(fresh)
+        assert sorted(os.listdir(self.tmpdir)) == ["a"]
+        assert sorted(os.listdir(os.path.join(self.tmpdir, "a"))) == ["b"]
+
+    def test_small_dirs_not_concurrent(self):
+        new_date = timestamp_before(weeks=1)
+        for n in range(10):
+            filename = self.mkfile("foo" + str(n))
+            os.utime(filename, (new_date, new_date))
+
+        threads = set()
+        def file_handler(filename):
+            threads.add(threading.current_thread())
+
+        cleanup_directory(self.tmpdir, timestamp_before(),
+            file_handler=file_handler, concurrency=4)
+        assert threads == set([threading.current_thread()])
+
+    @pytest.mark.skipif(is_win, reason="symlinks not supported")
+    def test_symlinked_dir(self):
+        outside_dir = tempfile.mkdtemp()
+        try:
+            new_date = timestamp_before(weeks=1)
+            filename = os.path.join(outside_dir, "foo.txt")
+            open(filename, "wb").close()
+            os.utime(filename, (new_date, new_date))
+            os.symlink(outside_dir, os.path.join(self.tmpdir, "link"))
+
+            cleanup_directory(self.tmpdir, timestamp_before())
+            # symlinked directories are not followed
+            assert os.path.exists(filename)
+        finally:
+            shutil.rmtree(outside_dir)
+
+    def test_dirs_removed_during_walk(self):
+        new_date = timestamp_before(weeks=1)
+        for d in ("b", "c"):
+            dirname = os.path.join(self.tmpdir, "a", d)
+            os.makedirs(dirname)
+            filename = os.path.join(dirname, "foo.txt")
+            open(filename, "wb").close()
+            os.utime(filename, (new_date, new_date))
+
+        def file_handler(filename):
+            # remove all other sub-directories, e.g. by another cleanup process
+            for d in ("a/b", "a/c"):
+                shutil.rmtree(os.path.join(self.tmpdir, d), ignore_errors=True)
+
+        cleanup_directory(self.tmpdir, timestamp_before(), file_handler=file_handler)
+        assert not os.path.exists(os.path.join(self.tmpdir, "a", "b"))
+        assert not os.path.exists(os.path.join(self.tmpdir, "a", "c"))
+
 
 def _write_atomic_data(i_filename):
     (i, filename) = i_filename
@@ -444,6 +555,68 @@ class TestWriteAtomic(object):
         os.unlink(filename)
         assert os.listdir(self.dirname) == []
 
+    def test_new_and_existing_file(self):
+        filename = os.path.join(self.dirname, "tmpfile")
+        write_atomic(filename, b"12345")
+        assert open(filename, "rb").read() == b"12345"
+        write_atomic(filename, b"678")
+        assert open(filename, "rb").read() == b"678"
+        assert os.listdir(self.dirname) == ["tmpfile"]
+
+    def test_overwrite_writes_once(self, monkeypatch):
+        filename = os.path.join(self.dirname, "tmpfile")
+        write_atomic(filename, b"12345")
+
+        opened = []
+        orig_fdopen = os.fdopen
+        def fdopen(fd, *args, **kw):
+            opened.append(fd)
+            return orig_fdopen(fd, *args, **kw)
+        monkeypatch.setattr(os, "fdopen", fdopen)
+
+        write_atomic(filename, b"678")
+        assert len(opened) == 1
+        assert open(filename, "rb").read() == b"678"
+        assert os.listdir(self.dirname) == ["tmpfile"]
+
+    def test_removed_directory(self):
+        filename = os.path.join(self.dirname, "foo", "tmpfile")
+        ensure_directory(filename, cached=True)
+        shutil.rmtree(os.path.join(self.dirname, "foo"))
+        # directory is remembered by ensure_directory
+        ensure_directory(filename, cached=True)
+        write_atomic(filename, b"12345")
+        assert open(filename, "rb").read() == b"12345"
+
+    def test_removed_directory_uncached(self):
+        filename = os.path.join(self.dirname, "foo", "link")
+        ensure_directory(filename)
+        shutil.rmtree(os.path.join(self.dirname, "foo"))
+        # directory is recreated for callers without write_atomic
+        ensure_directory(filename)
+        os.symlink("target", filename)
+        assert os.readlink(filename) == "target"
+
+    def test_read_only_directory(self, monkeypatch):
+        def mkdir(path):
+            raise OSError(errno.EROFS, "Read-only file system")
+        monkeypatch.setattr(os, "mkdir", mkdir)
+
+        # existing directory
+        ensure_directory(os.path.join(self.dirname, "tmpfile"))
+
+        with pytest.raises(OSError):
+            ensure_directory(os.path.join(self.dirname, "foo", "tmpfile"))
+
+    def test_missing_directory(self):
+        filename = os.path.join(self.dirname, "bar", "tmpfile")
+        try:
+            write_atomic(filename, b"12345")
+        except (OSError, IOError):
+            pass
+        else:
+            assert False, "expected exception"
+
     def test_not_a_file(self):
         # check that expected errors are not hidden
         filename = os.path.join(self.dirname, "tmpfile")
@@ -474,3 +647,164 @@ def test_reraise_exception():
         assert ex
     else:
         assert False, "expected exception"
+
+
+class TestMemoize(object):
+
+    class Counter(object):
+        def __init__(self):
+            self.calls = 0
+
+        @memoize
+        def value(self, n=1):
+            self.calls += 1
+            return [n]
+
+    def test_cached_per_args(self):
+        c = self.Counter()
+        assert c.value() is c.value()
+        assert c.value(2) is c.value(2)
+        assert c.value(n=3) == [3]
+        assert c.calls == 3
+
+    def test_cached_per_instance(self):
+        a = self.Counter()
+        b = self.Counter()
+        assert a.value() is not b.value()
+        assert a.calls == 1
+        assert b.calls == 1
+
+    def test_cached_via_class(self):
+        c = self.Counter()
+        v = c.value(5)
+        assert c.value(5) is v
+        assert self.Counter.value(c, 5) is v
+        assert c.calls == 1
+
+    @pytest.mark.parametrize("copy_func", [copy.copy, copy.deepcopy])
+    def test_copy(self, copy_func):
+        class Multiplier(object):
+            def __init__(self, x):
+                self.x = x
+
+            @memoize
+            def value(self, n):
+                return [self.x * n]
+
+        a = Multiplier(1)
+        v = a.value(1)
+        c = copy_func(a)
+        c.x = 3
+        assert c.value(2) == [6]
+        assert c.value(1) == [3]
+        assert c.value(1) is not v
+        assert a.value(1) is v
+        assert a.value(2) == [2]
+
+    def test_freed_without_gc(self):
+        c = self.Counter()
+        c.value()
+        ref = weakref.ref(c)
+        del c
+        assert ref() is None
+
+    def test_overridden(self):
+        class SubCounter(self.Counter):
+            @memoize
+            def value(self, n=1):
+                return super(SubCounter, self).value(n) + [n]
+
+        c = SubCounter()
+        assert c.value() == [1, 1]
+        assert c.value() is c.value()
+        assert c.calls == 1
+
+    def test_slots(self):
+        class SlotCounter(object):
+            __slots__ = ('calls', )
+
+            @memoize
+            def value(self):
+                return 1
+
+        with pytest.raises(TypeError):
+            SlotCounter().value()
+
+    def test_threshold(self):
+        class Counter(object):
+            def __init__(self):
+                self.calls = 0
+
+            @memoize(threshold_ns=0)
+            def slow(self):
+                self.calls += 1
+                time.sleep(0.001)
+                return []
+
+            @memoize(threshold_ns=10 * 1e9)
+            def fast(self):
+                self.calls += 1
+                return []
+
+        c = Counter()
+        assert c.slow() is c.slow()
+        assert c.calls == 1
+        assert c.fast() is not c.fast()
+        assert c.calls == 3
+
+
+class TestCachedProperty(object):
+
+    def test_cached_property(self):
+        class Foo(object):
+            calls = 0
+
+            @cached_property
+            def foo(self):
+                """Foo doc"""
+                self.calls += 1
+                return []
+
+        f = Foo()
+        assert f.foo is f.foo
+        assert f.calls == 1
+        assert Foo.foo.__doc__ == "Foo doc"
+
+    def test_slot(self):
+        class Foo(object):
+            __slots__ = ('calls', '_foo')
+
+            def __init__(self):
+                self.calls = 0
+
+            @cached_property(slot='_foo')
+            def foo(self):
+                self.calls += 1
+                return []
+
+        f = Foo()
+        assert not hasattr(f, '__dict__')
+        assert f.foo is f.foo
+        assert f.calls == 1
+        assert Foo.foo.__name__ == 'foo'
+
+    def test_slot_with_getattr(self):
+        class Foo(object):
+            __slots__ = ('other', '_foo')
+
+            def __init__(self, other):
+                self.other = other
+
+            def __getattr__(self, name):
+                return getattr(self.other, name)
+
+            @cached_property(slot='_foo')
+            def foo(self):
+                return []
+
+        class Other(object):
+            _foo = 'other'
+
+        f = Foo(Other())
+        assert f.foo == []
+        assert f.foo is f.foo
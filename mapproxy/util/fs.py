@@ -21,9 +21,43 @@ import time
 import os
 import sys
 import random
+import binascii
 import errno
 import shutil
 
+from collections import deque
+
+# SystemRandom reads from os.urandom, as the state of the random module
+# is shared between forked seed processes.
+_sysrandom = random.SystemRandom()
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    class _DirEntry(object):
+        """
+        Minimal replacement for os.DirEntry.
+        """
+        def __init__(self, path, name):
+            self.name = name
+            self.path = path
+
+        def is_dir(self):
+            return os.path.isdir(self.path)
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
+
+        def stat(self, follow_symlinks=True):
+            if follow_symlinks:
+                return os.stat(self.path)
+            return os.lstat(self.path)
+
+    def scandir(dirpath):
+        prefix = os.path.join(dirpath, '')
+        return [_DirEntry(prefix + name, name) for name in os.listdir(dirpath)]
+
 def swap_dir(src_dir, dst_dir, keep_old=False, backup_ext='.tmp'):
     """
     Rename `src_dir` to `dst_dir`. The `dst_dir` is first renamed to
@@ -40,6 +74,9 @@ def swap_dir(src_dir, dst_dir, keep_old=False, backup_ext='.tmp'):
     if os.path.exists(tmp_dir) and not keep_old:
         shutil.rmtree(tmp_dir)
 
+# with the random backoff, all tries wait about 10s in total
+_max_rename_tries = 40
+
 def _force_rename_dir(src_dir, dst_dir):
     """
     Rename `src_dir` to `dst_dir`. If `dst_dir` exists, it will be removed.
@@ -47,13 +84,18 @@ def _force_rename_dir(src_dir, dst_dir):
     # someone might recreate the directory between rmtree and rename,
     # so we try to remove it until we can rename our new directory
     rename_tries = 0
-    while rename_tries < 10:
+    while True:
         try:
             os.rename(src_dir, dst_dir)
         except OSError as ex:
             if ex.errno == errno.ENOTEMPTY or ex.errno == errno.EEXIST:
+                if rename_tries >= _max_rename_tries - 1:
+                    raise
                 if rename_tries > 0:
-                    time.sleep(2**rename_tries / 100.0) # from 10ms to 5s
+                    # random backoff, so that concurrent processes
+                    # do not retry at the same time. up to 10ms, 20ms,
+                    # 40ms, ..., capped at 500ms
+                    time.sleep(_sysrandom.random() * min(0.5, 0.005 * (1 << rename_tries)))
                 rename_tries += 1
                 shutil.rmtree(dst_dir)
             else:
@@ -62,54 +104,191 @@ def _force_rename_dir(src_dir, dst_dir):
             break # on success
 
 def cleanup_directory(directory, before_timestamp, remove_empty_dirs=True,
-                      file_handler=None):
+                      file_handler=None, concurrency=1):
+    """
+    Remove all files in `directory` and its sub-directories that were
+    modified before `before_timestamp`. Calls `file_handler` with the
+    filename instead of removing the file, if set.
+
+    With a `concurrency` > 1, the files of multiple directories are
+    checked and removed in parallel threads. This is faster on SSDs and
+    network file systems, but not on single hard drives. Directories
+    with only a few files are still processed in the calling thread.
+    """
     if file_handler is None:
-        if before_timestamp == 0 and remove_empty_dirs == True and os.path.exists(directory):
+        if (remove_empty_dirs == True and os.path.exists(directory)
+            and (before_timestamp == 0 or before_timestamp > time.time())):
+            # all files are older, no need to check each file
             shutil.rmtree(directory, ignore_errors=True)
+            _known_dirs.clear()
             return
 
         file_handler = os.remove
 
-    if os.path.exists(directory):
-        for dirpath, dirnames, filenames in os.walk(directory, topdown=False):
-            if not filenames:
-                if (remove_empty_dirs and not os.listdir(dirpath)
-                    and dirpath != directory):
-                    os.rmdir(dirpath)
-                continue
-            for filename in filenames:
-                filename = os.path.join(dirpath, filename)
-                try:
-                    if before_timestamp == 0:
-                        file_handler(filename)
-                    if os.lstat(filename).st_mtime < before_timestamp:
-                        file_handler(filename)
-                except OSError as ex:
-                    if ex.errno != errno.ENOENT: raise
-
-            if remove_empty_dirs:
-                remove_dir_if_emtpy(dirpath)
-
-        if remove_empty_dirs:
-            remove_dir_if_emtpy(directory)
+    if not os.path.exists(directory):
+        return
+
+    removed_dirs = set()
+    def remove_dir(dirpath, subdirs, is_empty):
+        if not remove_empty_dirs:
+            return
+        # skip rmdir if we know that the directory is not empty. rmdir
+        # itself fails for non-empty directories, so no need to list
+        # the directory again.
+        if is_empty and all(d in removed_dirs for d in subdirs):
+            if remove_dir_if_emtpy(dirpath):
+                removed_dirs.add(dirpath)
+        removed_dirs.difference_update(subdirs)
+
+    if concurrency < 2:
+        for dirpath, subdirs, files in _walk_bottom_up(directory):
+            is_empty = _remove_expired_files(files, before_timestamp, file_handler)
+            remove_dir(dirpath, subdirs, is_empty)
+        return
+
+    from multiprocessing.pool import ThreadPool
+
+    # Directories are finished in walk order, so all sub-directories
+    # are processed before their parent directory is removed.
+    pool = ThreadPool(concurrency)
+    try:
+        pending = deque()
+        for dirpath, subdirs, files in _walk_bottom_up(directory):
+            if len(files) < _min_concurrent_files:
+                # not worth the thread overhead
+                result = _remove_expired_files(files, before_timestamp, file_handler)
+                if not pending:
+                    remove_dir(dirpath, subdirs, result)
+                    continue
+            else:
+                result = pool.apply_async(_remove_expired_files,
+                    (files, before_timestamp, file_handler))
+            pending.append((dirpath, subdirs, result))
+            # limit the number of directories in the queue
+            if len(pending) > concurrency * 4:
+                remove_dir(*_pending_result(pending.popleft()))
+        while pending:
+            remove_dir(*_pending_result(pending.popleft()))
+    finally:
+        pool.terminate()
+        pool.join()
+
+# directories with fewer files are not removed in the thread pool
+_min_concurrent_files = 16
+
+def _pending_result(pending):
+    dirpath, subdirs, result = pending
+    if not isinstance(result, bool):
+        result = result.get()
+    return dirpath, subdirs, result
+
+def _walk_bottom_up(dirpath):
+    """
+    Walk `dirpath` with scandir. Yields a (dirpath, subdirs, files) tuple
+    for each directory, but only after all of its sub-directories.
+    `subdirs` is a list of paths, `files` a list of DirEntry objects.
+    Symlinks to directories are listed in `subdirs` but not followed,
+    and directories that can not be listed (e.g. removed by another
+    process in the meantime) are skipped, same as os.walk.
+    """
+    subdirs = []
+    files = []
+    try:
+        for entry in scandir(dirpath):
+            if entry.is_dir():
+                subdirs.append(entry)
+            else:
+                files.append(entry)
+    except OSError:
+        return
+
+    for entry in subdirs:
+        if not entry.is_symlink():
+            for result in _walk_bottom_up(entry.path):
+                yield result
+
+    yield dirpath, [entry.path for entry in subdirs], files
+
+def _remove_expired_files(files, before_timestamp, file_handler):
+    """
+    Call `file_handler` for all `files` (DirEntry objects) that were
+    modified before `before_timestamp`. Returns True if all files
+    were expired.
+    """
+    all_expired = True
+    if before_timestamp == 0:
+        expired = [entry.path for entry in files]
+    else:
+        expired = []
+        for entry in files:
+            try:
+                # DirEntry caches the stat result and gets it for free
+                # from the directory listing on Windows
+                if entry.stat(follow_symlinks=False).st_mtime < before_timestamp:
+                    expired.append(entry.path)
+                else:
+                    all_expired = False
+            except OSError as ex:
+                if ex.errno != errno.ENOENT: raise
+
+    for filename in expired:
+        try:
+            file_handler(filename)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT: raise
+
+    return all_expired
 
 def remove_dir_if_emtpy(directory):
+    """
+    Remove `directory` if it is empty. Returns False if it is not empty.
+    """
     try:
         os.rmdir(directory)
     except OSError as ex:
-        if ex.errno != errno.ENOENT and ex.errno != errno.ENOTEMPTY: raise
+        if ex.errno == errno.ENOTEMPTY: return False
+        if ex.errno != errno.ENOENT: raise
+    _known_dirs.discard(directory)
+    return True
+
+# directories created or checked by ensure_directory. tiles are stored
+# in the same directories over and over again
+_known_dirs = set()
+_max_known_dirs = 10000
 
-def ensure_directory(file_name):
+def ensure_directory(file_name, cached=False):
     """
     Create directory if it does not exist, else do nothing.
+
+    With `cached`, existing directories are remembered and not checked
+    again. Only use this if the file is written with write_atomic, as
+    it recreates remembered directories if they were removed in the
+    meantime (e.g. by a cleanup in another process).
     """
     dir_name = os.path.dirname(file_name)
-    if not os.path.exists(dir_name):
-        try:
-            os.makedirs(dir_name)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
+    if cached and dir_name in _known_dirs:
+        return
+    # try mkdir first, without checking if it exists: one syscall for
+    # new and for existing directories. only use makedirs if parent
+    # directories are missing.
+    try:
+        os.mkdir(dir_name)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            try:
+                os.makedirs(dir_name)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+        elif e.errno != errno.EEXIST:
+            # some file systems report EACCES/EROFS for existing
+            # directories (e.g. read-only mounts)
+            if not os.path.isdir(dir_name):
                 raise e
+    if cached:
+        if len(_known_dirs) >= _max_known_dirs:
+            _known_dirs.clear()
+        _known_dirs.add(dir_name)
 
 def write_atomic(filename, data):
     """
@@ -117,14 +296,25 @@ def write_atomic(filename, data):
     first and renames that file to the target filename afterwards.
     Rename is atomic on all POSIX platforms.
 
+    On Linux, `data` is written to an unnamed temporary file that is
+    linked to the target filename. This saves the rename for the common
+    case of new tiles.
+
     Falls back to normal write on Windows.
     """
     if not sys.platform.startswith('win'):
         # write to random filename to prevent concurrent writes in cases
-        # where file locking does not work (network fs)
-        path_tmp = filename + '.tmp-' + str(random.randint(0, 99999999))
+        # where file locking does not work (network fs).
+        # os.urandom is used as the state of the random module is
+        # shared between forked seed processes on older Pythons.
+        path_tmp = filename + '.tmp-' + binascii.hexlify(os.urandom(8)).decode('ascii')
+
+        if _tmpfile_supported and _write_tmpfile_linked(filename, path_tmp, data):
+            return
+
         try:
-            fd = os.open(path_tmp, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0o664)
+            fd = _open_in_known_dir(filename, path_tmp,
+                os.O_EXCL | os.O_CREAT | os.O_WRONLY)
             with os.fdopen(fd, 'wb') as f:
                 f.write(data)
             os.rename(path_tmp, filename)
@@ -135,10 +325,82 @@ def write_atomic(filename, data):
                 pass
             raise ex
     else:
-        fd = os.open(filename, os.O_CREAT | os.O_WRONLY, 0o664)
+        fd = _open_in_known_dir(filename, filename, os.O_CREAT | os.O_WRONLY)
         with os.fdopen(fd, 'wb') as f:
             f.write(data)
 
+def _open_in_known_dir(filename, path, flags):
+    """
+    Open `path` in the directory of `filename`. Recreates the directory
+    if it was removed after it was checked by ensure_directory.
+    """
+    try:
+        return os.open(path, flags, 0o664)
+    except OSError as ex:
+        dir_name = os.path.dirname(filename)
+        if ex.errno != errno.ENOENT or dir_name not in _known_dirs:
+            raise
+    _known_dirs.discard(dir_name)
+    ensure_directory(filename)
+    return os.open(path, flags, 0o664)
+
+
+_tmpfile_supported = hasattr(os, 'O_TMPFILE')
+
+def _write_tmpfile_linked(filename, path_tmp, data):
+    """
+    Write `data` to a new unnamed file with O_TMPFILE and link it to
+    `filename`. Readers see the complete file or no file at all.
+    Existing files are replaced by linking the written file to `path_tmp`
+    and renaming it to `filename`.
+
+    Returns False if nothing was written, e.g. if the file system
+    does not support O_TMPFILE.
+    """
+    global _tmpfile_supported
+    try:
+        fd = os.open(os.path.dirname(filename) or '.',
+            os.O_TMPFILE | os.O_WRONLY, 0o664)
+    except OSError as ex:
+        if ex.errno in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+            # not supported by kernel or file system
+            _tmpfile_supported = False
+        return False
+
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        # The /proc entry needs to be linked with linkat and
+        # AT_SYMLINK_FOLLOW. os.link only uses linkat if a dir_fd
+        # is passed, which is ignored for the absolute source path.
+        proc_path = '/proc/self/fd/%d' % fd
+        try:
+            os.link(proc_path, filename, src_dir_fd=fd)
+            return True
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                if not (ex.errno == errno.ENOENT
+                        and not os.path.isdir(os.path.dirname(filename) or '.')):
+                    # /proc is not mounted or linking is not permitted
+                    _tmpfile_supported = False
+                return False
+
+        # filename exists, replace it without writing data again
+        try:
+            os.link(proc_path, path_tmp, src_dir_fd=fd)
+        except OSError:
+            return False
+
+    try:
+        os.rename(path_tmp, filename)
+    except OSError as ex:
+        try:
+            os.unlink(path_tmp)
+        except OSError:
+            pass
+        raise ex
+    return True
+
 
 def find_exec(executable):
     """
@@ -16,18 +16,26 @@
 """
 Python related helper functions.
 """
-from functools import wraps
+import weakref
+
+from functools import wraps, update_wrapper
+from timeit import default_timer
 from mapproxy.compat import PY2
 
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2
+    lru_cache = None
+
 def reraise_exception(new_exc, exc_info):
     """
     Reraise exception (`new_exc`) with the given `exc_info`.
     """
-    _exc_class, _exc, tb = exc_info
     if PY2:
-        exec('raise new_exc.__class__, new_exc, tb')
+        exec('raise new_exc.__class__, new_exc, exc_info[2]')
     else:
-        raise new_exc.with_traceback(tb)
+        raise new_exc.with_traceback(exc_info[2])
 
 def reraise(exc_info):
     """
@@ -53,29 +61,141 @@ class cached_property(object):
             def foo(self):
                 # calculate something important here
                 return 42
+
+    Classes with `__slots__` have no instance `__dict__` to store the
+    value in. Declare an extra slot and pass its name as `slot`::
+
+        class Foo(object):
+            __slots__ = ('_foo', )
+
+            @cached_property(slot='_foo')
+            def foo(self):
+                return 42
     """
 
-    def __init__(self, func, name=None, doc=None):
+    def __init__(self, func=None, name=None, doc=None, slot=None):
+        self.func = None
+        self.slot = slot
+        self.__name__ = name
+        self.__doc__ = doc
+        if func is not None:
+            self(func)
+
+    def __call__(self, func):
         self.func = func
-        self.__name__ = name or func.__name__
-        self.__doc__ = doc or func.__doc__
+        self.__name__ = self.__name__ or func.__name__
+        self.__doc__ = self.__doc__ or func.__doc__
+        return self
 
     def __get__(self, obj, type=None):
         if obj is None:
             return self
+        if self.slot is not None:
+            try:
+                # object.__getattribute__ does not fall back to __getattr__
+                # of obj for slots that are not set yet
+                return object.__getattribute__(obj, self.slot)
+            except AttributeError:
+                value = self.func(obj)
+                object.__setattr__(obj, self.slot, value)
+                return value
         value = self.func(obj)
         setattr(obj, self.__name__, value)
         return value
 
-def memoize(func):
+_MISSING = object()
+
+def memoize(func=None, threshold_ns=None):
+    """
+    Cache the results of method `func` per instance. All arguments
+    need to be hashable. The cache is stored in the instance
+    ``__dict__``, classes with ``__slots__`` are not supported.
+
+    With `threshold_ns`, only results of calls that took longer than
+    `threshold_ns` nanoseconds are cached. Cheap calls are recomputed
+    each time, so use this only if callers do not rely on getting the
+    identical result object back::
+
+        @memoize(threshold_ns=100000)
+        def transform(self, x, y):
+            ...
+    """
+    if func is None:
+        return lambda func: memoize(func, threshold_ns=threshold_ns)
+    return _memoized_method(func, threshold_ns)
+
+class _memoized_method(object):
+    """
+    Method descriptor for `memoize`.
+
+    Results are cached with ``functools.lru_cache``, one cache per
+    instance, stored in the instance ``__dict__``. The cache only holds
+    a weak reference to the instance. This avoids reference cycles and
+    copies of the instance (copy/deepcopy) get their own cache.
+
+    Falls back to a dict based cache on Python 2 and with `threshold_ns`.
+    """
+    def __init__(self, func, threshold_ns=None):
+        update_wrapper(self, func)
+        self.func = func
+        self.use_lru_cache = lru_cache is not None and threshold_ns is None
+        self.wrapper = _memoize_wrapper(func, threshold_ns)
+        # the id keeps the name unique for overridden methods
+        self.cache_name = '_memoize_lru_%s_%x' % (func.__name__, id(func))
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        # both caches are stored in the instance __dict__
+        # (__dictoffset__ is 0 for classes with __slots__)
+        if not obj.__class__.__dictoffset__:
+            raise TypeError('memoize requires instances with __dict__, %s has __slots__'
+                % obj.__class__.__name__)
+        if not self.use_lru_cache:
+            return self.wrapper.__get__(obj, type)
+        cache = obj.__dict__.get(self.cache_name)
+        # cache is copied from another instance with copy/deepcopy
+        if cache is None or cache.instance_ref() is not obj:
+            cache = _weak_lru_cache(self.func, obj)
+            obj.__dict__[self.cache_name] = cache
+        return cache
+
+    def __call__(self, obj, *args, **kwargs):
+        return self.__get__(obj, obj.__class__)(*args, **kwargs)
+
+def _weak_lru_cache(func, obj):
+    instance_ref = weakref.ref(obj)
+
+    def method(*args, **kwargs):
+        return func(instance_ref(), *args, **kwargs)
+
+    cache = lru_cache(maxsize=None)(method)
+    cache.instance_ref = instance_ref
+    return cache
+
+def _memoize_wrapper(func, threshold_ns):
+    threshold = None
+    if threshold_ns is not None:
+        threshold = threshold_ns / 1e9
+
+    # one cache dict per method in the instance __dict__. the id keeps
+    # the name unique for overridden methods with the same name
+    cache_name = '_memoize_cache_%s_%x' % (func.__name__, id(func))
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        if not hasattr(self, '__memoize_cache'):
-            self.__memoize_cache = {}
-        cache = self.__memoize_cache.setdefault(func, {})
+        cache = self.__dict__.get(cache_name)
+        if cache is None:
+            cache = self.__dict__[cache_name] = {}
         key = args + tuple(kwargs.items())
-        if key not in cache:
-            cache[key] = func(self, *args, **kwargs)
-        return cache[key]
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            if threshold is None:
+                result = cache[key] = func(self, *args, **kwargs)
+            else:
+                start = default_timer()
+                result = func(self, *args, **kwargs)
+                if default_timer() - start > threshold:
+                    cache[key] = result
+        return result
     return wrapper
-
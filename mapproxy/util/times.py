@@ -17,6 +17,7 @@ from __future__ import absolute_import
 """
 Date and time utilities.
 """
+import time
 from time import mktime
 import datetime
 import calendar
@@ -53,9 +54,12 @@ def timestamp_before(weeks=0, days=0, hours=0, minutes=0, seconds=0):
     >>> time_.time() - timestamp_before(hours=2) - 7200 <= 1
     True
     """
-    delta = datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
-    before = datetime.datetime.now() - delta
-    return mktime(before.timetuple())
+    seconds = weeks * 604800 + days * 86400 + hours * 3600 + minutes * 60 + seconds
+    return time.time() - seconds
+
+_ISO_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Python >= 3.7
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
 
 def timestamp_from_isodate(isodate):
     """
@@ -70,6 +74,12 @@ def timestamp_from_isodate(isodate):
     """
     if isinstance(isodate, datetime.datetime):
         date = isodate
+    elif (_fromisoformat and len(isodate) == 19 and isodate[10] == 'T'
+          and isodate[4] == isodate[7] == '-'
+          and isodate[13] == isodate[16] == ':'):
+        # fromisoformat is much faster, but accepts more formats.
+        # only use it for strings in the expected format.
+        date = _fromisoformat(isodate)
     else:
-        date = datetime.datetime.strptime(isodate, "%Y-%m-%dT%H:%M:%S")
-    return mktime(date.timetuple())
\ No newline at end of file
+        date = datetime.datetime.strptime(isodate, _ISO_FORMAT)
+    return mktime(date.timetuple())